@@ -10,6 +10,11 @@ from htmlparser import *
 from cssparser import *
 from jscript import *
 
+import codecs
+import collections
+import queue
+import re
+import time
 import urllib
 import urllib.parse
 import dukpy
@@ -17,6 +22,213 @@ import dukpy
 browser_styles = open("browser.css")
 DEFAULT_STYLE_SHEET = CSSParser(browser_styles.read()).parse()
 
+# Resolve the hosts of <a href> links once a page is loaded, so that
+# following one of them skips DNS
+PRERESOLVE_LINKS = True
+
+# How often the Tk loop picks up work posted by the network engine
+TASK_POLL_MS = 16
+
+# Print each page load's request waterfall (see url.Waterfall)
+PRINT_WATERFALL = False
+
+# Finds <script src> and <link rel=stylesheet href> in raw HTML bytes as
+# they arrive, so subresource fetches can start before the DOM is built.
+class PreloadScanner:
+    TAG = re.compile(rb"<(script|link)\b([^>]*)>", re.IGNORECASE)
+    ATTRIBUTE = re.compile(
+        rb"""([^\s=/>]+)\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""")
+    MAX_PENDING = 64 * 1024
+
+    def __init__(self, on_resource):
+        self.on_resource = on_resource
+        self.pending = b""
+
+    def feed(self, data):
+        data = self.pending + data
+        end = 0
+        for match in self.TAG.finditer(data):
+            end = match.end()
+            self.scan_tag(match.group(1).lower(), match.group(2))
+        # Keep a tag that is split across chunks for the next feed
+        start = data.rfind(b"<", end)
+        if start == -1 or len(data) - start > self.MAX_PENDING:
+            self.pending = b""
+        else:
+            self.pending = data[start:]
+
+    def scan_tag(self, tag, text):
+        attributes = {}
+        for key, value in self.ATTRIBUTE.findall(text):
+            if len(value) > 2 and value[:1] in (b"'", b'"'):
+                value = value[1:-1]
+            key = key.decode("utf8", "replace").casefold()
+            attributes[key] = value.decode("utf8", "replace")
+        if tag == b"script" and "src" in attributes:
+            self.on_resource(attributes["src"], PRIORITY_SCRIPT)
+        elif tag == b"link" and "href" in attributes \
+            and attributes.get("rel") == "stylesheet":
+            self.on_resource(attributes["href"], PRIORITY_STYLESHEET)
+
+# Network state for one navigation. Everything here is safe to run off
+# the UI thread; Tab.commit_load then builds the page from it.
+class PageLoad:
+    def __init__(self, url, referrer, payload=None, on_text=None):
+        self.url = url
+        self.referrer = referrer
+        self.payload = payload
+        self.subresources = {}
+        self.allowed_origins = None
+        # Streaming: on_text gets the body as decoded text as it arrives,
+        # and the tab parses it into self.parser on the UI thread.
+        self.on_text = on_text
+        self.decoder = None
+        self.parser = None
+        self.painted = False
+        self.waterfall = Waterfall(url)
+
+    def fetch(self):
+        self.scanner = PreloadScanner(self.preload)
+        headers, body, self.url = self.waterfall.track(self.url.request,
+            self.referrer, self.payload,
+            on_headers=self.receive_headers, on_chunk=self.receive_chunk)
+        self.waterfall.mark("response")
+        if self.on_text and self.decoder:
+            text = self.decoder.decode(b"", final=True)
+            if text: self.on_text(text)
+        return headers, body
+
+    # After a redirect the page lives at the URL its headers came from,
+    # so preloads resolve against that and the tab commits it.
+    def receive_headers(self, headers, url):
+        self.url = url
+        self.apply_csp(headers)
+        self.decoder = codecs.getincrementaldecoder(
+            body_charset(headers))("replace")
+
+    def receive_chunk(self, data):
+        self.scanner.feed(data)
+        if self.on_text and self.decoder:
+            text = self.decoder.decode(data)
+            if text: self.on_text(text)
+
+    def apply_csp(self, headers):
+        self.allowed_origins = None
+        if "content-security-policy" in headers:
+            csp = headers["content-security-policy"].split()
+            if len(csp) > 0 and csp[0] == "default-src":
+                self.allowed_origins = []
+                for origin in csp[1:]:
+                    self.allowed_origins.append(URL(origin).origin())
+
+    def allowed_request(self, url):
+        return self.allowed_origins == None or \
+            url.origin() in self.allowed_origins
+
+    def preload(self, src, priority):
+        try:
+            sub_url = self.url.resolve(src)
+        except Exception:
+            return
+        if self.allowed_request(sub_url):
+            self.fetch_subresource(sub_url, priority)
+
+    # Subresources are fetched concurrently through FETCH_SCHEDULER, so
+    # a page waits for its slowest fetch rather than the sum of them,
+    # and render-blocking ones go ahead of XHRs and prefetches.
+    def fetch_subresource(self, url, priority):
+        key = str(url)
+        if key not in self.subresources:
+            self.subresources[key] = FETCH_SCHEDULER.submit(priority, url,
+                self.waterfall.track, url.request, self.url)
+        return self.subresources[key]
+
+# Speculation is opt-in: preconnect to the origins of links on screen,
+# and prefetch a link into the HTTP cache once the pointer has rested on
+# it for HOVER_DWELL_MS. At most MAX_PRECONNECTS preconnects are
+# outstanding at once, each given PRECONNECT_TIMEOUT seconds to connect.
+# Prefetches are limited to PREFETCH_BANDWIDTH bytes per minute, and at
+# most PREFETCH_CACHE_BYTES of prefetched responses are kept in the
+# cache.
+SPECULATE = False
+HOVER_DWELL_MS = 200
+MAX_PRECONNECTS = 6
+PRECONNECT_TIMEOUT = 2
+PREFETCH_BANDWIDTH = 2 * 1024 * 1024
+PREFETCH_CACHE_BYTES = 8 * 1024 * 1024
+
+# Runs on the Tk thread; network work goes to FETCH_SCHEDULER at
+# prefetch priority, so it never delays a real page load.
+class Speculator:
+    def __init__(self, browser):
+        self.browser = browser
+        self.viewport = None
+        self.preconnected = {}
+        self.connecting = set()
+        self.hovered = None
+        self.timer = None
+        self.prefetching = set()
+        self.prefetched = collections.OrderedDict()
+        self.transferred = collections.deque()
+
+    def update_viewport(self, tab):
+        viewport = (tab, tab.document, tab.scroll)
+        if viewport == self.viewport: return
+        self.viewport = viewport
+        now = time.time()
+        for link in tab.visible_links():
+            if len(self.connecting) >= MAX_PRECONNECTS: break
+            if link.scheme not in ("http", "https"): continue
+            origin = link.origin()
+            if now - self.preconnected.get(origin, 0) < \
+                CONNECTION_POOL.idle_timeout:
+                continue
+            self.preconnected[origin] = now
+            self.connecting.add(origin)
+            future = FETCH_SCHEDULER.submit(PRIORITY_PREFETCH, link,
+                preconnect, link, PRECONNECT_TIMEOUT)
+            future.add_done_callback(lambda future, origin=origin:
+                self.browser.post(self.connecting.discard, origin))
+
+    def hover(self, tab, link):
+        if link == self.hovered: return
+        self.hovered = link
+        if self.timer:
+            self.browser.window.after_cancel(self.timer)
+            self.timer = None
+        if link:
+            self.timer = self.browser.window.after(
+                HOVER_DWELL_MS, self.prefetch, tab, link)
+
+    def bandwidth_used(self):
+        now = time.time()
+        while self.transferred and now - self.transferred[0][0] > 60:
+            self.transferred.popleft()
+        return sum(size for _, size in self.transferred)
+
+    def prefetch(self, tab, link):
+        self.timer = None
+        key = str(link)
+        if link.scheme not in ("http", "https") or link == tab.url: return
+        if key in self.prefetching or key in self.prefetched: return
+        if self.bandwidth_used() >= PREFETCH_BANDWIDTH: return
+        self.prefetching.add(key)
+        future = FETCH_SCHEDULER.submit(
+            PRIORITY_PREFETCH, link, link.request, tab.url)
+        future.add_done_callback(lambda future:
+            self.browser.post(self.finish_prefetch, key, future))
+
+    def finish_prefetch(self, key, future):
+        self.prefetching.discard(key)
+        if future.exception(): return
+        headers, body, _ = future.result()
+        size = len(body.encode(body_charset(headers), "replace"))
+        self.transferred.append((time.time(), size))
+        self.prefetched[key] = size
+        while sum(self.prefetched.values()) > PREFETCH_CACHE_BYTES:
+            old, _ = self.prefetched.popitem(last=False)
+            HTTP_CACHE.discard(old)
+
 class Browser:
     def __init__(self):
         self.window = tkinter.Tk()
@@ -33,12 +245,61 @@ class Browser:
         self.window.bind("<Button-1>", self.handle_click)
         self.window.bind("<Key>", self.handle_key)
         self.window.bind("<Return>", self.handle_enter)
+        self.window.bind("<Motion>", self.handle_motion)
 
         self.tabs = []
         self.active_tab = None
         self.chrome = Chrome(self)
         self.focus = None
 
+        self.tasks = queue.Queue()
+        self.engine = NetworkEngine()
+        self.window.after(TASK_POLL_MS, self.run_tasks)
+        self.speculator = Speculator(self) if SPECULATE else None
+
+    # Called from any thread; the task runs later on the Tk thread
+    def post(self, task, *args):
+        self.tasks.put((task, args))
+
+    def run_tasks(self):
+        try:
+            while True:
+                try:
+                    task, args = self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+                task(*args)
+        finally:
+            self.window.after(TASK_POLL_MS, self.run_tasks)
+
+    def schedule_load(self, tab, url, payload=None):
+        page = PageLoad(url, tab.url, payload,
+            on_text=lambda text: self.post(self.stream_text, tab, page, text))
+        tab.pending_load = page
+        self.engine.submit(self.load_in_background(tab, page))
+
+    async def load_in_background(self, tab, page):
+        try:
+            headers, body = await self.engine.run(page.fetch)
+            # Also wait for whatever the preload scanner started, so
+            # committing on the Tk thread does not block on the network.
+            await self.engine.wait(list(page.subresources.values()))
+        except Exception as e:
+            print("Failed to load", page.url, e)
+            return
+        self.post(self.finish_load, tab, page, headers, body)
+
+    def stream_text(self, tab, page, text):
+        if tab.pending_load is not page: return
+        if tab.receive_text(page, text) and tab == self.active_tab:
+            self.draw()
+
+    def finish_load(self, tab, page, headers, body):
+        if tab.pending_load is not page: return
+        tab.pending_load = None
+        tab.commit_load(page, headers, body)
+        self.draw()
+
     def handle_enter(self, e):
         self.chrome.enter()
         self.draw()
@@ -62,6 +323,13 @@ class Browser:
             self.active_tab.click(tab_x, tab_y)
         self.draw()
     
+    def handle_motion(self, e):
+        if not self.speculator or not self.active_tab: return
+        link = None
+        if e.y >= self.chrome.bottom:
+            link = self.active_tab.link_at(e.x, e.y - self.chrome.bottom)
+        self.speculator.hover(self.active_tab, link)
+
     def handle_key(self, e):
         if len(e.char) == 0: return
         if not (0x20 <= ord(e.char) < 0x7f): return
@@ -76,30 +344,78 @@ class Browser:
         self.draw()
 
     def new_tab(self, url):
-        new_tab = Tab(HEIGHT - self.chrome.bottom)
-        new_tab.load(url)
+        new_tab = Tab(HEIGHT - self.chrome.bottom, self)
         self.active_tab = new_tab
         self.tabs.append(new_tab)
+        new_tab.navigate(url)
         self.draw()
+
     def draw(self):
         self.canvas.delete("all")
         self.active_tab.draw(self.canvas, self.chrome.bottom)
         for cmd in self.chrome.paint():
             cmd.execute(0, self.canvas)
+        if self.speculator:
+            self.speculator.update_viewport(self.active_tab)
 
 class Tab:
-    def __init__(self, tab_height):
+    def __init__(self, tab_height, browser=None):
         self.url = None
         self.tab_height = tab_height
+        self.browser = browser
         self.history = []
         self.focus = None
+        self.js = None
         self.valid_certificate = False
+        self.scroll = 0
+        self.document = None
+        self.display_list = []
+        self.allowed_origins = None
+        self.pending_load = None
+        self.waterfall = None
     
     def load(self, url, payload=None):
-        headers, body = url.request(self.url, payload)
+        page = PageLoad(url, self.url, payload)
+        headers, body = page.fetch()
+        self.commit_load(page, headers, body)
+
+    # Loads through the browser's network engine when there is one, so
+    # the UI keeps running while the page downloads.
+    def navigate(self, url, payload=None):
+        if self.browser:
+            self.browser.schedule_load(self, url, payload)
+        else:
+            self.load(url, payload)
+
+    # Parses streamed text as it arrives. Returns True when the partial
+    # page was painted for the first time, which happens as soon as
+    # <body> has content. Scripts only run once the page is committed,
+    # so until then the partial page has no JS context and its events
+    # go straight to the default actions.
+    def receive_text(self, page, text):
+        if not page.parser:
+            page.parser = HTMLParser()
+        page.parser.feed(text)
+        if page.painted or not has_body_content(page.parser.root()):
+            return False
+        page.painted = True
+        self.scroll = 0
+        self.url = page.url
+        self.focus = None
+        self.nodes = page.parser.root()
+        self.js = None
+        self.rules = DEFAULT_STYLE_SHEET.copy()
+        self.render()
+        page.waterfall.mark("first paint")
+        return True
+
+    def commit_load(self, page, headers, body):
+        url = page.url
+        self.allowed_origins = page.allowed_origins
         self.scroll = 0
         self.url = url
         self.history.append(url)
+        self.waterfall = page.waterfall
         
         #ch10 Certificate errors
         if url.scheme == "https":
@@ -107,30 +423,28 @@ class Tab:
         if "invalid-certificate" in headers:
             self.valid_certificate = False
             
-        self.nodes = HTMLParser(body).parse()
+        if page.parser:
+            self.nodes = page.parser.close()
+        else:
+            self.nodes = HTMLParser(body).parse()
+        page.waterfall.mark("parsed")
         self.js = JSContext(self)
 
-        self.allowed_origins = None
-        if "content-security-policy" in headers:
-            csp = headers["content-security-policy"].split()
-            if len(csp) > 0 and csp[0] == "default-src":
-                self.allowed_origins = []
-                for origin in csp[1:]:
-                    self.allowed_origins.append(URL(origin).origin())
-
-        scripts = [node.attributes["src"] for node
-                   in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "script"
-                   and "src" in node.attributes]
+        # Anything the preload scanner missed starts fetching now; the
+        # results are still consumed in document order below.
+        for href in self.stylesheet_hrefs():
+            page.preload(href, PRIORITY_STYLESHEET)
+        for src in self.script_srcs():
+            page.preload(src, PRIORITY_SCRIPT)
 
-        for script in scripts:
+        for script in self.script_srcs():
             script_url = url.resolve(script)
             if not self.allowed_request(script_url):
                 print("Blocked script", script, "due to CSP")
                 continue
             try:
-                header, body = script_url.request(url)
+                header, body, _ = page.fetch_subresource(
+                    script_url, PRIORITY_SCRIPT).result()
             except:
                 continue
 
@@ -138,26 +452,57 @@ class Tab:
                 self.js.run(body)
             except dukpy.JSRuntimeError as e:
                 print("Script", script, "crashed", e)
+        page.waterfall.mark("scripts run")
 
         self.rules = DEFAULT_STYLE_SHEET.copy()
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and node.attributes.get("rel") == "stylesheet"
-                 and "href" in node.attributes]
-        for link in links:
+        for link in self.stylesheet_hrefs():
             style_url = url.resolve(link)
             if not self.allowed_request(style_url):
                 print("Blocked style", link, "due to CSP")
                 continue
             try:
-                header, body = style_url.request(url)
+                header, body, _ = page.fetch_subresource(
+                    style_url, PRIORITY_STYLESHEET).result()
             except:
                 continue
             self.rules.extend(CSSParser(body).parse())
         self.render()
-    
+        page.waterfall.mark("rendered")
+        if PRINT_WATERFALL:
+            print(page.waterfall.render())
+        if PRERESOLVE_LINKS:
+            self.preresolve_links()
+
+    def preresolve_links(self):
+        origins = set()
+        for node in tree_to_list(self.nodes, []):
+            if isinstance(node, Element) and node.tag == "a" \
+                and "href" in node.attributes:
+                try:
+                    link = self.url.resolve(node.attributes["href"])
+                except Exception:
+                    continue
+                if link.host: origins.add((link.host, link.port))
+        for host, port in origins:
+            if not RESOLVER.lookup(host, port):
+                FETCH_SCHEDULER.submit(PRIORITY_PREFETCH, None,
+                    RESOLVER.resolve, host, port)
+
+    def script_srcs(self):
+        return [node.attributes["src"] for node
+                in tree_to_list(self.nodes, [])
+                if isinstance(node, Element)
+                and node.tag == "script"
+                and "src" in node.attributes]
+
+    def stylesheet_hrefs(self):
+        return [node.attributes["href"]
+                for node in tree_to_list(self.nodes, [])
+                if isinstance(node, Element)
+                and node.tag == "link"
+                and node.attributes.get("rel") == "stylesheet"
+                and "href" in node.attributes]
+
     def allowed_request(self, url):
         return self.allowed_origins == None or \
             url.origin() in self.allowed_origins
@@ -170,12 +515,13 @@ class Tab:
 
     def keypress(self, char):
         if self.focus:
-            if self.js.dispatch_event("keydown", self.focus): return
+            if self.js and self.js.dispatch_event("keydown", self.focus):
+                return
             self.focus.attributes["value"] += char
             self.render()
     
     def submit_form(self, elt):
-        if self.js.dispatch_event("submit", elt): return
+        if self.js and self.js.dispatch_event("submit", elt): return
         inputs = [node for node in tree_to_list(elt, [])
                   if isinstance(node, Element)
                   and node.tag == "input"
@@ -190,7 +536,7 @@ class Tab:
         body = body[1:]
 
         url = self.url.resolve(elt.attributes["action"])
-        self.load(url, body)
+        self.navigate(url, body)
     
     def draw(self, canvas, offset):
         for cmd in self.display_list:
@@ -200,6 +546,7 @@ class Tab:
             cmd.execute(self.scroll - offset, canvas)
 
     def scrolldown(self):
+        if not self.document: return
         max_y = max(
             self.document.height + 2 * VSTEP - self.tab_height, 0)
         self.scroll = min(self.scroll + SCROLL_STEP, max_y)
@@ -213,6 +560,7 @@ class Tab:
             self.focus.is_focused = False
 
         self.focus = None
+        if not self.document: return
         y += self.scroll
         
         objs = [obj for obj in tree_to_list(self.document, [])
@@ -226,11 +574,11 @@ class Tab:
             if isinstance(elt, Text):
                 elt = elt.parent
             elif elt.tag == "a" and "href" in elt.attributes:
-                if self.js.dispatch_event("click", elt): return
+                if self.js and self.js.dispatch_event("click", elt): return
                 url = self.url.resolve(elt.attributes["href"])
-                return self.load(url)
+                return self.navigate(url)
             elif elt.tag == "input":
-                if self.js.dispatch_event("click", elt): return
+                if self.js and self.js.dispatch_event("click", elt): return
                 elt.attributes["value"] = ""
                 if self.focus:
                     self.focus.is_focused = False
@@ -238,22 +586,61 @@ class Tab:
                 elt.is_focused = True
                 return self.render()
             elif elt.tag == "button":
-                if self.js.dispatch_event("click", elt): return
+                if self.js and self.js.dispatch_event("click", elt): return
                 while elt:
                     if elt.tag == "form" and "action" in elt.attributes:
                         return self.submit_form(elt)
                     elt = elt.parent
             elt = elt.parent
       
+    def link_at(self, x, y):
+        if not self.document: return None
+        y += self.scroll
+        nodes = [obj.node for obj in tree_to_list(self.document, [])
+                 if hasattr(obj, "node")
+                 and obj.x <= x < obj.x + obj.width
+                 and obj.y <= y < obj.y + obj.height]
+        return self.link_of(nodes[-1]) if nodes else None
+
+    def visible_links(self):
+        if not self.document: return []
+        top, bottom = self.scroll, self.scroll + self.tab_height
+        links = []
+        for obj in tree_to_list(self.document, []):
+            if not hasattr(obj, "node") or \
+                obj.y + obj.height < top or obj.y > bottom:
+                continue
+            link = self.link_of(obj.node)
+            if link and link not in links: links.append(link)
+        return links
+
+    def link_of(self, node):
+        while node:
+            if isinstance(node, Element) and node.tag == "a" \
+                and "href" in node.attributes:
+                try:
+                    return self.url.resolve(node.attributes["href"])
+                except Exception:
+                    return None
+            node = node.parent
+        return None
+
     def go_back(self):
         if len(self.history) > 1:
             self.history.pop()
             back = self.history.pop()
-            self.load(back)
+            self.navigate(back)
     
     def __repr__(self):
         return "Tab(history={})".format(self.history)
     
+def has_body_content(root):
+    if not root: return False
+    for child in root.children:
+        if isinstance(child, Element) and child.tag == "body":
+            return len(child.children) > 0
+    return False
+    
 class Chrome:
     def __init__(self, browser):
         self.browser = browser
@@ -353,8 +740,15 @@ class Chrome:
                 self.address_rect.bottom,
                 "red", 1))
         else:
-            url = str(self.browser.active_tab.url)
-            if self.browser.active_tab.valid_certificate:
+            # A new tab has no URL until its first page is shown
+            tab = self.browser.active_tab
+            if tab.url:
+                url = str(tab.url)
+            elif tab.pending_load:
+                url = str(tab.pending_load.url)
+            else:
+                url = ""
+            if tab.valid_certificate:
                 url += "\N{lock}"
             cmds.append(DrawText(
                 self.address_rect.left + self.padding,
@@ -388,13 +782,30 @@ class Chrome:
     
     def enter(self):
         if self.focus == "address bar":
-            self.browser.active_tab.load(URL(self.address_bar))
+            self.browser.active_tab.navigate(URL(self.address_bar))
             self.focus = None
 
     def blur(self):
             self.focus = None
 
 if __name__ == "__main__":
-    import sys
-    Browser().new_tab(URL(sys.argv[1]))
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--record", metavar="ARCHIVE",
+                        help="save every network response to ARCHIVE")
+    parser.add_argument("--replay", metavar="ARCHIVE",
+                        help="serve every request from ARCHIVE")
+    parser.add_argument("--replay-latency", action="store_true",
+                        help="wait as long as the recorded responses took")
+    parser.add_argument("--waterfall", action="store_true",
+                        help="print a request waterfall after each load")
+    parser.add_argument("--speculate", action="store_true",
+                        help="preconnect to and prefetch likely next pages")
+    args = parser.parse_args()
+    PRINT_WATERFALL = args.waterfall
+    SPECULATE = args.speculate
+    if args.record: start_recording(args.record)
+    if args.replay: start_replay(args.replay, args.replay_latency)
+    Browser().new_tab(URL(args.url))
     tkinter.mainloop()
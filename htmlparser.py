@@ -1,21 +1,37 @@
+import html
+import re
+import sys
+import types
+
+# Nodes share these until something gives them their own: cssparser's
+# style() assigns every node a fresh style dict, and elements parsed
+# without attributes keep the read-only empty mapping.
+NO_STYLE = types.MappingProxyType({})
+NO_ATTRIBUTES = types.MappingProxyType({})
+
 class Text:
+    __slots__ = ("text", "parent", "style")
+    children = ()
+    is_focused = False
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
         self.parent = parent
-        self.style = {}
-        self.is_focused = False
+        self.style = NO_STYLE
 
     def __repr__(self): 
         return repr(self.text)
 
 class Element:
+    __slots__ = ("tag", "attributes", "children", "parent", "style",
+                 "is_focused")
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.attributes = attributes
         self.children = []
         self.parent = parent
-        self.style = {}
+        self.style = NO_STYLE
         self.is_focused = False
         
     def __repr__(self):
@@ -26,99 +42,301 @@ class Element:
         return "<" + self.tag + attr_str + ">"
     
 class HTMLParser:
-    def __init__(self, body):
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        self.mode = "before-html"
+        self.text = ""
+        self.in_tag = False
+        # Inside a quoted attribute value, the quote and the tag so far
+        self.quote = ""
+        self.tag_parts = []
+        # Tag text -> (tag, NO_ATTRIBUTES) for tags without attributes,
+        # which are most of them, so "p" or "/b" is only parsed once
+        self.simple_tags = {}
+        # Inside <!-- -->, only the last two characters matter
+        self.in_comment = False
+        self.comment_tail = ""
+        # Inside <script> or <style>, text runs until the matching end tag
+        self.raw = None
+        self.raw_end = None
+        self.raw_lt = False
 
+    # Tag and attribute names are interned, so every <p> shares one "p".
+    # Values may be double-quoted, single-quoted or unquoted, and have
+    # character references decoded; the first of two same-named
+    # attributes wins. Returns None if the text ends inside a quoted
+    # value, which means the '>' after it does not end the tag. Splitting
+    # on the quote character leaves the quoted values at odd indices and
+    # plain name=value parts in between; anything else (both kinds of
+    # quote, spaces around '=', a stray '/') goes through scan_attributes.
     def get_attributes(self, text):
-        parts = text.split()
-        tag = parts[0].casefold()
+        if '"' in text:
+            if "'" in text: return self.scan_attributes(text)
+            segments = text.split('"')
+        elif "'" in text: segments = text.split("'")
+        else: segments = [text]
+        last = len(segments) - 1
+        if last % 2: return self.scan_attributes(text)
+        parts = segments[0].split()
+        if not parts: return self.scan_attributes(text)
+        name = parts[0]
+        if "/" in name and "/" in name[1:] or last and len(parts) == 1:
+            return self.scan_attributes(text)
+        tag = sys.intern(name.casefold())
+        if len(parts) == 1:
+            if tag in self.MUTABLE_ATTRIBUTE_TAGS: return tag, {}
+            return tag, NO_ATTRIBUTES
+        attributes = {}
+        del parts[0]
+        for i in range(0, last + 1, 2):
+            if i: parts = segments[i].split()
+            if i < last:
+                if not segments[i].endswith("="):
+                    return self.scan_attributes(text)
+                quoted = parts.pop()[:-1]
+            for part in parts:
+                key, equals, value = part.partition("=")
+                if not key or "/" in key:
+                    if part == "/": continue
+                    return self.scan_attributes(text)
+                if value:
+                    if "&" in value: value = html.unescape(value)
+                elif equals:
+                    return self.scan_attributes(text)
+                attributes.setdefault(sys.intern(key.casefold()), value)
+            if i < last:
+                if not quoted or "/" in quoted or "=" in quoted:
+                    return self.scan_attributes(text)
+                value = segments[i + 1]
+                if "&" in value: value = html.unescape(value)
+                attributes.setdefault(sys.intern(quoted.casefold()), value)
+        if not attributes and tag not in self.MUTABLE_ATTRIBUTE_TAGS:
+            return tag, NO_ATTRIBUTES
+        return tag, attributes
+
+    def scan_attributes(self, text):
+        match = self.TAG_NAME.match(text)
+        tag = sys.intern(match.group(1).casefold())
+        pairs = self.ATTRIBUTE.findall(text, match.end())
+        if not pairs:
+            if tag in self.MUTABLE_ATTRIBUTE_TAGS: return tag, {}
+            return tag, NO_ATTRIBUTES
+        if pairs[-1][3]: return None
         attributes = {}
-        for attrpair in parts[1:]:
-            if "=" in attrpair:
-                key, value = attrpair.split("=", 1)
-                if len(value) > 2 and value[0] in ["'", "\""]:
-                    value = value[1:-1]
-                attributes[key.casefold()] = value
-            else:
-                attributes[attrpair.casefold()] = ""
-            
+        for key, double, single, _, bare in pairs:
+            value = double or single or bare
+            if "&" in value: value = html.unescape(value)
+            attributes.setdefault(sys.intern(key.casefold()), value)
         return tag, attributes
 
+    # Which implicit tags a token needs depends only on the insertion
+    # mode: "before-html" (nothing open), "before-head" (just <html>),
+    # "in-head" (<html><head>) or "in-body" (anything else). The mode is
+    # updated whenever an element opens or closes, so this is constant
+    # time per token.
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            if self.mode == "before-html" and tag != "html":
                 self.add_tag("html")
 
-            elif open_tags == ["html"] \
-                and tag not in ["head", "body", "/html"]:
+            elif self.mode == "before-head" \
+                and tag not in self.HTML_CHILD_TAGS:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            
 
-            elif open_tags == ["html", "head"] and \
-                tag not in ["/head"] + self.HEAD_TAGS:
+            elif self.mode == "in-head" and tag != "/head" and \
+                tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else: break
+
+    def update_mode(self):
+        unfinished = self.unfinished
+        if not unfinished:
+            self.mode = "before-html"
+        elif len(unfinished) > 2 or unfinished[0].tag != "html":
+            self.mode = "in-body"
+        elif len(unfinished) == 1:
+            self.mode = "before-head"
+        elif unfinished[1].tag == "head":
+            self.mode = "in-head"
+        else:
+            self.mode = "in-body"
     
     def parse(self):
-        text = ""
-        in_tag = False
-        for c in self.body:
-            if c == "<":
-                in_tag = True
-                if text: self.add_text(text)
-                text = ""
-            elif c == ">":
-                in_tag = False
-                self.add_tag(text)
-                text = ""
-            else:
-                text += c
-        if not in_tag and text:
-            self.add_text(text)
+        self.feed(self.body)
+        return self.close()
+
+    # feed() can be called with any split of the document; a tag, text
+    # run, comment or script cut off at the end of a chunk is finished by
+    # the next one. The chunk is split on delimiters in one pass rather
+    # than walked a character at a time: '<' ends a text run and '>' ends
+    # a tag, except inside comments, <script>/<style> and quoted
+    # attribute values. Inside a quoted value, each later part is only
+    # searched for the closing quote, so an unclosed quote stays linear.
+    def feed(self, chunk):
+        parts = self.DELIMITER.split(chunk)
+        parts[0] = self.text + parts[0]
+        simple_tags = self.simple_tags
+        add_text, add_tag = self.add_text, self.add_tag
+        for text, delimiter in zip(parts[0::2], parts[1::2]):
+            if self.raw is not None:
+                if self.raw_lt and self.is_raw_end(text):
+                    self.end_raw()
+                else:
+                    if self.raw_lt: self.raw.append("<")
+                    self.raw.append(text)
+                    self.raw_lt = delimiter == "<"
+                    if not self.raw_lt: self.raw.append(">")
+                    continue
+            if self.quote:
+                end = text.find(self.quote)
+                if end != -1: self.quote = self.open_quote(text, end + 1)
+                if self.quote:
+                    self.tag_parts.append(text + delimiter)
+                    continue
+                self.tag_parts.append(text)
+                text = "".join(self.tag_parts)
+                self.tag_parts = []
+            if self.in_comment or self.in_tag and text[:3] == "!--":
+                if not self.in_comment:
+                    self.in_comment = True
+                    self.comment_tail = ""
+                    text = text[3:]
+                self.comment_tail = (self.comment_tail + text)[-2:]
+                if delimiter == ">" and self.comment_tail == "--":
+                    self.in_comment = False
+                    self.in_tag = False
+                else:
+                    self.comment_tail = (self.comment_tail + delimiter)[-2:]
+                continue
+            if delimiter == "<":
+                if self.in_tag and text[:1] != "!" and \
+                    self.get_attributes(text) is None:
+                    self.open_tag_quote(text, delimiter)
+                    continue
+                self.in_tag = True
+                if text: add_text(text)
+                continue
+            if text[:1] == "!":
+                self.in_tag = False
+                continue
+            token = simple_tags.get(text)
+            if token is None:
+                token = self.get_attributes(text)
+                if token is None:
+                    if self.in_tag: self.open_tag_quote(text, delimiter)
+                    continue
+                if token[1] is NO_ATTRIBUTES: simple_tags[text] = token
+            self.in_tag = False
+            tag = token[0]
+            if not tag: continue
+            add_tag(tag, token[1])
+            # Only an element that just opened can be <script> or <style>
+            if tag in self.RAW_TEXT_TAGS:
+                self.raw = []
+                self.raw_end = "/" + tag
+                self.raw_lt = False
+        text = parts[-1]
+        if self.in_comment:
+            self.comment_tail = (self.comment_tail + text)[-2:]
+            text = ""
+        elif self.raw is not None and not self.raw_lt:
+            self.raw.append(text)
+            text = ""
+        self.text = text
+
+    def open_tag_quote(self, text, delimiter):
+        start = self.TAG_NAME.match(text).end()
+        self.quote = self.open_quote(text, start)
+        self.tag_parts.append(text + delimiter)
+
+    # The quote character if text, from start on, ends inside a quoted
+    # attribute value, and "" otherwise
+    def open_quote(self, text, start):
+        pairs = self.ATTRIBUTE.findall(text, start)
+        return pairs[-1][3][:1] if pairs else ""
+
+    def is_raw_end(self, text):
+        end = self.raw_end
+        return text[:len(end)].casefold() == end and \
+            (len(text) == len(end) or text[len(end)] in " \t\n\f\r/")
+
+    def end_raw(self):
+        text = "".join(self.raw)
+        self.raw = None
+        if text: self.add_text(text)
+
+    def close(self):
+        if self.raw is not None:
+            if self.raw_lt: self.raw.append("<" + self.text)
+            self.text = ""
+            self.end_raw()
+        if not self.in_tag and not self.in_comment and self.text:
+            self.add_text(self.text)
+        self.text = ""
         return self.finish()
 
+    # Open elements are attached to their parent as soon as they are
+    # created, so this is a live view of the tree parsed so far.
+    def root(self):
+        return self.unfinished[0] if self.unfinished else None
+
     def add_text(self, text):
         if text.isspace(): return
-        self.implicit_tags(None)
+        if self.mode != "in-body": self.implicit_tags(None)
         parent = self.unfinished[-1] 
         node = Text(text, parent)
         parent.children.append(node)
 
-    def add_tag(self, tag):
-        if tag.startswith("!"): return
-        
-        tag, attributes = self.get_attributes(tag)
-        self.implicit_tags(tag)
+    def add_tag(self, tag, attributes=NO_ATTRIBUTES):
+        if not tag: return
+        if self.mode != "in-body": self.implicit_tags(tag)
+        unfinished = self.unfinished
 
-        if tag in self.SELF_CLOSING_TAGS:
-            parent = self.unfinished[-1]
-            node = Element(tag, attributes, parent)
-            parent.children.append(node)
+        if tag[0] == "/":
+            if len(unfinished) == 1: return
+            unfinished.pop()
+            if len(unfinished) < 3: self.update_mode()
 
-        elif tag.startswith("/"):
-            if len(self.unfinished) == 1: return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+        elif tag in self.SELF_CLOSING_TAGS:
+            parent = unfinished[-1]
+            parent.children.append(Element(tag, attributes, parent))
         else:
-            parent = self.unfinished[-1] if self.unfinished else None
+            parent = unfinished[-1] if unfinished else None
             node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            if parent: parent.children.append(node)
+            unfinished.append(node)
+            if len(unfinished) < 4: self.update_mode()
         
     def finish(self):
         if not self.unfinished:
             self.implicit_tags(None)
         while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+            self.unfinished.pop()
+        node = self.unfinished.pop()
+        self.update_mode()
+        return node
     
+    DELIMITER = re.compile("([<>])")
+
+    # "/p" for end tags; a "/" after the name, as in <br/>, is dropped
+    TAG_NAME = re.compile(r"\s*(/?[^\s/]*)")
+    # Name, then a double-quoted, single-quoted or unquoted value. The
+    # fourth group catches a quote that is never closed, which can only
+    # be the last match since it runs to the end of the text.
+    ATTRIBUTE = re.compile(r"""([^\s/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'"""
+                           r"""|(["'][\s\S]*)|(\S*)))?""")
+
+    RAW_TEXT_TAGS = ["script", "style"]
+
+    # The browser writes the value of these as the user types
+    MUTABLE_ATTRIBUTE_TAGS = ["input"]
+
+    HTML_CHILD_TAGS = ["head", "body", "/html"]
+
     HEAD_TAGS = [
         "base", "basefont", "bgsound", "noscript",
         "link", "meta", "title", "style", "script",
@@ -132,4 +350,67 @@ class HTMLParser:
 def print_tree(node, indent=0):
     print(" " * indent, node)
     for child in node.children:
-        print_tree(child, indent + 2)
\ No newline at end of file
+        print_tree(child, indent + 2)
+
+# Parse throughput on a file, or on about 5 MB of generated markup,
+# against the per-character loop feed() replaced; then the memory each
+# node of a generated 100k-node DOM takes, which fails above
+# NODE_BYTES_BUDGET (nodes took about 400 bytes before they were slotted)
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+
+    NODE_BYTES_BUDGET = 220
+
+    class CharacterParser(HTMLParser):
+        def feed(self, chunk):
+            for c in chunk:
+                if c == "<":
+                    self.in_tag = True
+                    if self.text: self.add_text(self.text)
+                    self.text = ""
+                elif c == ">":
+                    self.in_tag = False
+                    token = None
+                    if not self.text.startswith("!"):
+                        token = self.get_attributes(self.text)
+                    if token: self.add_tag(*token)
+                    self.text = ""
+                else:
+                    self.text += c
+
+    def throughput(parser, body):
+        start = time.perf_counter()
+        parser(body).parse()
+        elapsed = time.perf_counter() - start
+        return len(body.encode("utf8")) / 1e6 / elapsed
+
+    if len(sys.argv) > 1:
+        body = open(sys.argv[1], encoding="utf8").read()
+    else:
+        paragraph = "<p>" + "Lorem ipsum dolor sit amet, " * 20 + \
+            "<a href=/next>next</a> <b>bold</b></p>\n"
+        body = "<html><body>" + paragraph * (5_000_000 // len(paragraph))
+    before = throughput(CharacterParser, body)
+    after = throughput(HTMLParser, body)
+    print("{:.1f} MB: per-character {:.1f} MB/s, split {:.1f} MB/s, "
+          "{:.1f}x".format(len(body.encode("utf8")) / 1e6,
+                           before, after, after / before))
+
+    def bytes_per_node(body):
+        tracemalloc.start()
+        root = HTMLParser(body).parse()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        count, stack = 0, [root]
+        while stack:
+            count += 1
+            stack.extend(stack.pop().children)
+        return count, size / count
+
+    row = '<div class="row"><p>Some text <b>bold</b> and ' \
+        '<a href=/x>link</a>.</p><img src=a.png><br></div>\n'
+    count, per_node = bytes_per_node("<html><body>" + row * 12500)
+    print("{} nodes: {:.0f} bytes/node".format(count, per_node))
+    if per_node > NODE_BYTES_BUDGET:
+        sys.exit("over the budget of {} bytes/node".format(NODE_BYTES_BUDGET))
@@ -67,28 +67,18 @@ class JSContext:
         full_url = self.tab.url.resolve(url)
         if not self.tab.allowed_request(full_url):
             raise Exception("Cross-origin XHR blocked by CSP")
-        headers, out = full_url.request(self.tab.url, body)
+        headers, out, _ = FETCH_SCHEDULER.submit(PRIORITY_XHR, full_url,
+            full_url.request, self.tab.url, body).result()
         if full_url.origin() != self.tab.url.origin():
             raise Exception("Cross-origin XHR request not allowed")
         return out
 
     # Ch10 script access exercise
     def document_get_cookie(self):
-        if not COOKIE_JAR or self.tab.url.host not in COOKIE_JAR: 
-            return ""
-        else:
-            cookie, params = COOKIE_JAR[self.tab.url.host]
-            if "httponly" in params:
-                return ""
-            return cookie
+        return COOKIE_JAR.script_cookie(self.tab.url)
 
     def document_set_cookie(self, cookie):
-        if self.tab.url.host in COOKIE_JAR:
-            cookies, new_params = COOKIE_JAR[self.tab.url.host]
-            if "httponly" in new_params:
-                return
-        cookie, params = self.tab.url.get_cookie(cookie)
-        COOKIE_JAR[self.tab.url.host] = (cookie, params)
+        COOKIE_JAR.set(self.tab.url, cookie, from_script=True)
 
 def tree_to_list(tree, list):
     list.append(tree)
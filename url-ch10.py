@@ -1,157 +1,1631 @@
+import asyncio
+import atexit
+import codecs
+import collections
+import concurrent.futures
+import email.utils
+import functools
+import hashlib
+import json
+import mmap
+import os
+import queue
 import socket
 import ssl
+import sys
+import threading
+import time
 import urllib
 import urllib.parse
+import zlib
 from server import *
 
-COOKIE_JAR = {}
+# One SSLContext for the whole process, plus the last TLS session seen
+# for each origin so repeat connections can resume instead of doing a
+# full handshake.
+SSL_CONTEXT = None
+SSL_LOCK = threading.Lock()
+TLS_SESSIONS = {}
+TLS_STATS = {"resumed": 0, "full": 0}
+
+def get_ssl_context():
+    global SSL_CONTEXT
+    with SSL_LOCK:
+        if SSL_CONTEXT is None:
+            SSL_CONTEXT = ssl.create_default_context()
+        return SSL_CONTEXT
+
+# Caches getaddrinfo results per (host, port) for ttl seconds
+class Resolver:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, host, port):
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry and time.time() < entry[0]:
+                return entry[1]
+        return None
+
+    def resolve(self, host, port):
+        addresses = self.lookup(host, port)
+        if addresses: return addresses
+        addresses = socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+        with self.lock:
+            self.entries[(host, port)] = (time.time() + self.ttl, addresses)
+        return addresses
+
+RESOLVER = Resolver()
+
+# Connect latency per host, in seconds, for the most recent connections
+CONNECT_TIMES = collections.defaultdict(
+    lambda: collections.deque(maxlen=100))
+
+HAPPY_EYEBALLS_DELAY = 0.25
+
+# Alternate address families so that a broken IPv6 (or IPv4) route
+# only costs one HAPPY_EYEBALLS_DELAY before the other family is tried.
+def interleave_families(addresses):
+    first = [a for a in addresses if a[0] == addresses[0][0]]
+    rest = [a for a in addresses if a[0] != addresses[0][0]]
+    ordered = []
+    while first or rest:
+        if first: ordered.append(first.pop(0))
+        if rest: ordered.append(rest.pop(0))
+    return ordered
+
+# Starts a connection attempt every HAPPY_EYEBALLS_DELAY seconds, or as
+# soon as the previous one fails, and keeps the first to succeed.
+def happy_eyeballs(addresses, delay=HAPPY_EYEBALLS_DELAY, timeout=None):
+    results = queue.Queue()
+    state = {"winner": None}
+    lock = threading.Lock()
+
+    def attempt(address):
+        family, type, proto, _, sockaddr = address
+        s = socket.socket(family, type, proto)
+        s.settimeout(timeout)
+        try:
+            s.connect(sockaddr)
+        except OSError as e:
+            s.close()
+            results.put(e)
+            return
+        with lock:
+            if state["winner"] is None:
+                state["winner"] = s
+                results.put(s)
+                return
+        s.close()
+
+    addresses = interleave_families(addresses)
+    started = failed = 0
+    error = None
+    while True:
+        if started < len(addresses) and started == failed:
+            threading.Thread(target=attempt, args=(addresses[started],),
+                             daemon=True).start()
+            started += 1
+        try:
+            wait = delay if started < len(addresses) else None
+            result = results.get(timeout=wait)
+        except queue.Empty:
+            threading.Thread(target=attempt, args=(addresses[started],),
+                             daemon=True).start()
+            started += 1
+            continue
+        if not isinstance(result, Exception):
+            return result
+        failed += 1
+        error = result
+        if failed == len(addresses):
+            raise error
+
+def open_socket(host, port):
+    return connect_socket(RESOLVER.resolve(host, port))
+
+# A timeout, if given, stays set on the socket; URL.connect clears it
+# once the connection is ready
+def connect_socket(addresses, timeout=None):
+    if len(addresses) == 1:
+        family, type, proto, _, sockaddr = addresses[0]
+        s = socket.socket(family, type, proto)
+        s.settimeout(timeout)
+        try:
+            s.connect(sockaddr)
+        except OSError:
+            s.close()
+            raise
+        return s
+    return happy_eyeballs(addresses, timeout=timeout)
+
+class Connection:
+    def __init__(self, scheme, host, port, timeout=None):
+        self.key = (scheme, host, port)
+        self.host = host
+        start = time.perf_counter()
+        addresses = RESOLVER.resolve(host, port)
+        resolved = time.perf_counter()
+        self.sock = connect_socket(addresses, timeout)
+        connected = time.perf_counter()
+        CONNECT_TIMES[host].append(connected - start)
+        # Phase times for the request that opened this connection
+        self.dns_time = resolved - start
+        self.connect_time = connected - resolved
+        self.tls_time = 0
+        self.response = None
+        self.last_used = time.time()
+
+    def start_tls(self):
+        ctx = get_ssl_context()
+        session = TLS_SESSIONS.get(self.key)
+        start = time.perf_counter()
+        self.sock = ctx.wrap_socket(
+            self.sock, server_hostname=self.host, session=session)
+        self.tls_time = time.perf_counter() - start
+        with SSL_LOCK:
+            if self.sock.session_reused:
+                TLS_STATS["resumed"] += 1
+            else:
+                TLS_STATS["full"] += 1
+        self.save_session()
+
+    # TLS 1.3 servers send session tickets after the handshake, so this
+    # is called again once a response has been read.
+    def save_session(self):
+        session = getattr(self.sock, "session", None)
+        if session is not None:
+            TLS_SESSIONS[self.key] = session
+
+    def reader(self):
+        if not self.response:
+            self.response = ResponseReader(self.sock)
+        return self.response
+
+    def close(self):
+        self.sock.close()
+
+# Keep-alive pool: idle sockets per (scheme, host, port)
+class ConnectionPool:
+    def __init__(self, idle_timeout=30, max_idle=6):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host, port):
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get((scheme, host, port), [])
+            while conns:
+                conn = conns.pop()
+                if now - conn.last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+        return None
+
+    def count(self, scheme, host, port):
+        with self.lock:
+            return len(self.idle.get((scheme, host, port), []))
+
+    def put(self, conn):
+        conn.last_used = time.time()
+        with self.lock:
+            conns = self.idle.setdefault(conn.key, [])
+            conns.append(conn)
+            while len(conns) > self.max_idle:
+                conns.pop(0).close()
+
+    def close_all(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+CONNECTION_POOL = ConnectionPool()
+
+# Opens a connection (DNS, TCP and TLS) to url's origin ahead of a
+# request and parks it in the pool, unless an idle one is already there.
+def preconnect(url, timeout=None):
+    if url.scheme not in ("http", "https"): return
+    if CONNECTION_POOL.count(url.scheme, url.host, url.port): return
+    conn = url.connect(timeout)
+    if conn: CONNECTION_POOL.put(conn)
+
+PHASES = ["dns", "connect", "tls", "ttfb", "body"]
+
+# Timing, byte counts and cache state for one request. Phases are in
+# seconds; dns, connect and tls stay 0 on a reused connection. cache is
+# "miss", "hit", "stale-hit" (served stale while revalidating),
+# "revalidated" (304), "coalesced", "archive" or "file".
+class RequestRecord:
+    def __init__(self, url, method, cache="miss"):
+        self.url = url
+        self.method = method
+        self.status = None
+        self.content_encoding = "identity"
+        self.bytes_on_wire = 0
+        self.bytes_decoded = 0
+        self.cache = cache
+        # True when this request shared another in-flight fetch
+        self.coalesced = cache == "coalesced"
+        self.reused = False
+        self.phases = dict.fromkeys(PHASES, 0)
+        self.start = time.perf_counter()
+        self.end = None
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_json(self, origin=None):
+        return {
+            "url": self.url, "method": self.method, "status": self.status,
+            "cache": self.cache, "reused": self.reused,
+            "content_encoding": self.content_encoding,
+            "bytes_on_wire": self.bytes_on_wire,
+            "bytes_decoded": self.bytes_decoded,
+            "start": self.start - (origin or self.start),
+            "duration": self.duration() if self.end else None,
+            "phases": dict(self.phases),
+        }
 
-class URL:
     def __repr__(self):
-        return "URL(scheme={}, host={}, port={}, path={!r})".format(
-            self.scheme, self.host, self.port, self.path)
-    
-    def __str__(self):
-        port_part = ":" + str(self.port)
-        if self.scheme == "https" and self.port == 443:
-            port_part = ""
-        if self.scheme == "http" and self.port == 80:
-            port_part = ""
-        return self.scheme + "://" + self.host + port_part + self.path
-    
-    cache = dict()
+        return "RequestRecord({} {} status={} cache={} encoding={} wire={} decoded={}{})".format(
+            self.method, self.url, self.status, self.cache,
+            self.content_encoding, self.bytes_on_wire, self.bytes_decoded,
+            " coalesced" if self.coalesced else "")
 
-    def __init__(self, url, redirect=0) -> None:
-        self.scheme, url = url.split("://", 1)
+REQUEST_LOG = collections.deque(maxlen=1000)
 
-        self.redirect = redirect
-        if (self.redirect >= 10):
-            raise RedirectLoopError(Exception("Too many redirects"))
-        
-        assert self.scheme in ("http", "https", "file")
+# The waterfall that requests made on this thread belong to
+CURRENT_LOAD = threading.local()
 
-        if self.scheme == "http":
-            self.port = 80
-        elif self.scheme == "https":
-            self.port = 443
-        elif self.scheme == "file":
-            self.port = None
-            self.host = None
+def log_request(record):
+    REQUEST_LOG.append(record)
+    waterfall = getattr(CURRENT_LOAD, "waterfall", None)
+    if waterfall: waterfall.add(record)
 
-        if "\\" in url:
-            if self.scheme != "file":
-                _, url = url.split("\\", 1)
-                self.path = "\\" + url
+# All requests made for one page load, plus named milestones such as
+# first paint, so a slow load can be split into network and main-thread
+# time. Work for the load must run inside track() to be counted.
+class Waterfall:
+    def __init__(self, url):
+        self.url = str(url)
+        self.start = time.perf_counter()
+        self.records = []
+        self.marks = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def mark(self, name):
+        with self.lock:
+            self.marks.append((name, time.perf_counter() - self.start))
+
+    def track(self, fn, *args, **kwargs):
+        previous = getattr(CURRENT_LOAD, "waterfall", None)
+        CURRENT_LOAD.waterfall = self
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            CURRENT_LOAD.waterfall = previous
+
+    # Seconds during which at least one request was in flight
+    def network_time(self):
+        spans = sorted((r.start, r.end or time.perf_counter())
+                       for r in self.records)
+        total = 0
+        covered = self.start
+        for start, end in spans:
+            start = max(start, covered)
+            if end > start:
+                total += end - start
+                covered = end
+        return total
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "url": self.url,
+                "network_time": self.network_time(),
+                "requests": [record.to_json(self.start)
+                             for record in self.records],
+                "marks": [{"name": name, "time": at}
+                          for name, at in self.marks],
+            }
+
+    # One row per request: d=dns c=connect s=tls w=waiting for the first
+    # byte r=receiving the body; a cached response shows as '='.
+    def render(self, width=60):
+        with self.lock:
+            records = sorted(self.records, key=lambda r: r.start)
+            marks = list(self.marks)
+        ends = [r.duration() + r.start - self.start for r in records]
+        total = max(ends + [at for _, at in marks] + [0.001])
+        scale = width / total
+        lines = ["{} ({:.0f} ms, {:.0f} ms on the network)".format(
+            self.url, total * 1000, self.network_time() * 1000)]
+        for record in records:
+            offset = int((record.start - self.start) * scale)
+            if record.cache in ("miss", "revalidated"):
+                bar = "".join(letter * int(round(record.phases[phase] * scale))
+                              for phase, letter in zip(PHASES, "dcswr")) or "r"
             else:
-                self.path = url
+                bar = "=" * max(1, int(round(record.duration() * scale)))
+            lines.append("{:<{}} {:>6.0f} ms {:>8} {:<11} {}".format(
+                " " * offset + bar, width, record.duration() * 1000,
+                record.bytes_on_wire, record.cache, record.url))
+        for name, at in marks:
+            lines.append("{:<{}} {:>6.0f} ms {}".format(
+                " " * int(at * scale) + "|", width, at * 1000, name))
+        return "\n".join(lines)
+
+# Identical GETs that are in flight at the same time share one fetch.
+# Keys are the URL plus the cookie header, the only request header that
+# varies between callers.
+INFLIGHT = {}
+INFLIGHT_LOCK = threading.Lock()
+
+CHUNK_SIZE = 64 * 1024
 
-        if self.scheme != "file":
-            if "/" not in url:
-                url = url + "/"
-            self.host, url = url.split("/", 1)
-            self.path = "/" + url
+def read_length(response, length):
+    while length > 0:
+        data = response.read(min(length, CHUNK_SIZE))
+        if not data:
+            raise ConnectionError("Connection closed mid-body")
+        length -= len(data)
+        yield data
+
+def read_chunked(response):
+    while True:
+        line = response.readline()
+        if not line:
+            raise ConnectionError("Connection closed mid-body")
+        size = int(line.split(b";", 1)[0].strip(), 16)
+        if size == 0: break
+        yield from read_length(response, size)
+        response.readline()
+    while response.readline() not in (b"\r\n", b""):
+        pass
+
+def read_until_close(response):
+    while True:
+        data = response.read(CHUNK_SIZE)
+        if not data: return
+        yield data
+
+# Reads responses off a socket through one bytearray that is reused for
+# every response on the connection. Bodies of known length are received
+# straight into the caller's buffer with read_into.
+class ResponseReader:
+    def __init__(self, sock, size=CHUNK_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def buffered(self):
+        return self.end - self.start
+
+    def fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            if self.start > 0:
+                count = self.buffered()
+                self.buffer[:count] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, count
+            else:
+                self.buffer.extend(bytes(len(self.buffer)))
+        count = self.sock.recv_into(memoryview(self.buffer)[self.end:])
+        self.end += count
+        return count
+
+    def find(self, separator):
+        scanned = 0
+        while True:
+            i = self.buffer.find(separator, self.start + scanned, self.end)
+            if i != -1: return i
+            scanned = max(self.buffered() - len(separator) + 1, 0)
+            if not self.fill(): return -1
+
+    # Status line and headers, without the blank line after them
+    def read_head(self):
+        i = self.find(b"\r\n\r\n")
+        if i == -1:
+            if self.buffered():
+                raise ConnectionError("Connection closed mid-headers")
+            return None
+        head = bytes(self.buffer[self.start:i])
+        self.start = i + 4
+        return head
+
+    def readline(self):
+        i = self.find(b"\n")
+        end = self.end if i == -1 else i + 1
+        line = bytes(self.buffer[self.start:end])
+        self.start = end
+        return line
+
+    def read(self, size):
+        if not self.buffered() and not self.fill(): return b""
+        size = min(size, self.buffered())
+        data = bytes(self.buffer[self.start:self.start + size])
+        self.start += size
+        return data
+
+    def read_into(self, view):
+        if not self.buffered():
+            return self.sock.recv_into(view)
+        count = min(len(view), self.buffered())
+        view[:count] = memoryview(self.buffer)[self.start:self.start + count]
+        self.start += count
+        return count
+
+# Set-Cookie may be repeated, so those values are also returned as a list
+def parse_head(head):
+    statusline, *lines = head.decode("iso-8859-1").split("\r\n")
+    version, status, explanation = (statusline + " ").split(" ", 2)
+    headers = {}
+    cookies = []
+    for line in lines:
+        header, value = line.split(":", 1)
+        header = header.casefold()
+        headers[header] = value.strip()
+        if header == "set-cookie":
+            cookies.append(value.strip())
+    return version, int(status), headers, cookies
+
+def body_charset(headers):
+    content_type = headers.get("content-type", "")
+    for param in content_type.split(";")[1:]:
+        if "=" not in param: continue
+        name, value = param.split("=", 1)
+        if name.strip().casefold() != "charset": continue
+        charset = value.strip().strip('"')
+        try:
+            codecs.lookup(charset)
+            return charset
+        except LookupError:
+            break
+    return "utf8"
+
+# Bodies stay bytes until a caller needs text, and are decoded once with
+# the charset the server declared.
+def decode_body(headers, data):
+    return str(data, body_charset(headers), "replace")
+
+class ContentDecoder:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding in ("gzip", "x-gzip"):
+            self.zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.zlib = zlib.decompressobj(zlib.MAX_WBITS)
         else:
-            self.path = url
+            assert encoding == "identity"
+            self.zlib = None
+        self.started = False
 
-        if self.scheme == "file":
-            self.port = None
-            self.host = None
-            self.path = url
-        elif ":" in self.host:
-            self.host, port = self.host.split(":", 1)
-            self.port = int(port)
-    
-    def request(self, referrer, payload=None):
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP,
-        )
-        s.connect((self.host, self.port))
+    def decode(self, data):
+        if not self.zlib: return data
+        if not self.started and self.encoding == "deflate":
+            # Some servers send raw deflate without the zlib wrapper
+            self.started = True
+            try:
+                return self.zlib.decompress(data)
+            except zlib.error:
+                self.zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.zlib.decompress(data)
+
+    def flush(self):
+        if not self.zlib: return b""
+        return self.zlib.flush()
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().casefold()
+        if not directive: continue
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip()] = arg.strip().strip('"')
+        else:
+            directives[directive] = None
+    return directives
+
+def directive_seconds(directives, name):
+    try:
+        return max(int(directives.get(name) or 0), 0)
+    except ValueError:
+        return 0
+
+def has_validators(headers):
+    return "etag" in headers or "last-modified" in headers
+
+def conditional_headers(headers):
+    conditions = {}
+    if "etag" in headers:
+        conditions["If-None-Match"] = headers["etag"]
+    if "last-modified" in headers:
+        conditions["If-Modified-Since"] = headers["last-modified"]
+    return conditions
+
+def replay_cached(url, headers, body, on_headers, on_chunk):
+    if on_headers: on_headers(headers, url)
+    if on_chunk and body: on_chunk(body)
+
+BODY_HEADERS = ["content-length", "content-encoding", "transfer-encoding"]
+
+# Disk-backed HTTP cache. Bodies live in one file each and are only
+# mapped in when looked up; index.json holds headers, expiry and the
+# LRU order, so the cache survives restarts. Changes to the index are
+# written at most every INDEX_SAVE_DELAY seconds, and at exit.
+CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "browser-engineering")
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+MAX_REDIRECT_ENTRIES = 1000
+INDEX_SAVE_DELAY = 5
+
+class HTTPCache:
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # 301/308 source URL -> target URL, also in LRU order
+        self.redirects = collections.OrderedDict()
+        self.max_redirects = MAX_REDIRECT_ENTRIES
+        self.loaded = False
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.save_timer = None
+        self.save_lock = threading.Lock()
+        self.revalidating = set()
+        # Serve any stale entry that has a validator right away and
+        # refresh it in the background, not just those whose response
+        # carried a stale-while-revalidate directive.
+        self.stale_while_revalidate = False
+
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def body_path(self, key):
+        name = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name + ".body")
+
+    def load(self):
+        if self.loaded: return
+        self.loaded = True
+        try:
+            with open(self.index_path(), "r", encoding="utf8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, entry in index.get("entries", []):
+            if os.path.exists(self.body_path(key)):
+                self.entries[key] = entry
+                self.size += entry["size"]
+        for source, target in index.get("redirects", []):
+            self.redirects[source] = target
+
+    def mark_dirty(self):
+        self.dirty = True
+        if not self.save_timer:
+            self.save_timer = threading.Timer(INDEX_SAVE_DELAY, self.save)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    # The index is serialised under the cache lock but written outside
+    # it; save_lock keeps two saves from writing out of order.
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                self.save_timer = None
+                if not self.dirty: return
+                self.dirty = False
+                index = json.dumps({
+                    "entries": list(self.entries.items()),
+                    "redirects": list(self.redirects.items()),
+                })
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.index_path() + ".tmp"
+            with open(tmp, "w", encoding="utf8") as f:
+                f.write(index)
+            os.replace(tmp, self.index_path())
+
+    # Returns a view of the mapping rather than a copy; the mapping is
+    # closed once the last view of it is dropped. Bodies are replaced
+    # by rename and never rewritten in place, so a view stays valid
+    # after its entry is stored again or evicted.
+    def read_body(self, key, size):
+        if size == 0: return b""
+        with open(self.body_path(key), "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(m)[:size]
+
+    # Returns (headers, body, state) where state is "fresh", "stale"
+    # (must be revalidated before use) or "stale-while-revalidate" (may
+    # be used while a background request refreshes it).
+    def lookup(self, key):
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if not entry: return None
+            now = time.time()
+            if now < entry["expires"]:
+                state = "fresh"
+            elif not has_validators(entry["headers"]):
+                self.remove(key)
+                return None
+            elif self.stale_while_revalidate or \
+                now < entry["expires"] + entry["swr"]:
+                state = "stale-while-revalidate"
+            else:
+                state = "stale"
+            self.entries.move_to_end(key)
+            try:
+                body = self.read_body(key, entry["size"])
+            except (OSError, ValueError):
+                self.remove(key)
+                return None
+        return dict(entry["headers"]), body, state
+
+    def lifetime(self, headers):
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        if "no-store" in directives: return None
+        max_age = directive_seconds(directives, "max-age")
+        if "no-cache" in directives: max_age = 0
+        if max_age <= 0 and not has_validators(headers): return None
+        swr = directive_seconds(directives, "stale-while-revalidate")
+        return time.time() + max_age, swr
+
+    def store(self, key, headers, body):
+        lifetime = self.lifetime(headers)
+        with self.lock:
+            self.load()
+            if key in self.entries:
+                self.remove(key)
+            if not lifetime or len(body) > self.max_bytes:
+                return
+            expires, swr = lifetime
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.body_path(key)
+            with open(path + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(path + ".tmp", path)
+            self.entries[key] = {
+                "headers": headers,
+                "size": len(body),
+                "expires": expires,
+                "swr": swr,
+            }
+            self.size += len(body)
+            self.evict()
+            self.mark_dirty()
+
+    # A 304 Not Modified keeps the stored body but may update headers
+    # such as ETag or Cache-Control.
+    def refresh(self, key, headers):
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if not entry: return None
+            merged = dict(entry["headers"])
+            for header, value in headers.items():
+                if header not in BODY_HEADERS:
+                    merged[header] = value
+            lifetime = self.lifetime(merged)
+            if not lifetime:
+                self.remove(key)
+                return merged
+            entry["headers"] = merged
+            entry["expires"], entry["swr"] = lifetime
+            self.entries.move_to_end(key)
+            self.mark_dirty()
+            return merged
+
+    def revalidate_in_background(self, key, fetch):
+        with self.lock:
+            if key in self.revalidating: return
+            self.revalidating.add(key)
+        def run():
+            try:
+                fetch()
+            except Exception:
+                pass
+            finally:
+                with self.lock:
+                    self.revalidating.discard(key)
+        threading.Thread(target=run, daemon=True).start()
+
+    def remember_redirect(self, source, target):
+        with self.lock:
+            self.load()
+            self.redirects[source] = target
+            self.redirects.move_to_end(source)
+            while len(self.redirects) > self.max_redirects:
+                self.redirects.popitem(last=False)
+            self.mark_dirty()
+
+    # Follows remembered permanent redirects to the end of the chain
+    def lookup_redirect(self, source):
+        with self.lock:
+            self.load()
+            target = self.redirects.get(source)
+            if not target: return None
+            self.redirects.move_to_end(source)
+            seen = {source}
+            while target in self.redirects and target not in seen:
+                seen.add(target)
+                target = self.redirects[target]
+            return target
+
+    def discard(self, key):
+        with self.lock:
+            self.load()
+            if key in self.entries:
+                self.remove(key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry["size"]
+        self.mark_dirty()
+        try:
+            os.remove(self.body_path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self.remove(key)
+
+HTTP_CACHE = HTTPCache(CACHE_DIR)
+atexit.register(HTTP_CACHE.save)
+
+# ch10 script access exercise
+def parse_cookie(text):
+    params = {}
+    cookie = text
+    if ";" in text:
+        cookie, rest = text.split(";", 1)
+        for param in rest.split(";"):
+            if '=' in param:
+                param, value = param.split("=", 1)
+            else:
+                value = "true"
+            params[param.strip().casefold()] = value.strip()
+    if "samesite" in params:
+        params["samesite"] = params["samesite"].casefold()
+    cookie = cookie.strip()
+    if "=" in cookie:
+        name, value = cookie.split("=", 1)
+    else:
+        name, value = "", cookie
+    return name.strip(), value.strip(), params
+
+def cookie_expiry(params, now):
+    if "max-age" in params:
+        try:
+            return now + int(params["max-age"])
+        except ValueError:
+            pass
+    if "expires" in params:
+        try:
+            return email.utils.parsedate_to_datetime(
+                params["expires"]).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def default_cookie_path(path):
+    if not path.startswith("/") or path.count("/") == 1:
+        return "/"
+    return path.rsplit("/", 1)[0]
+
+def path_matches(request_path, cookie_path):
+    if request_path == cookie_path: return True
+    return request_path.startswith(cookie_path) and \
+        (cookie_path.endswith("/") or request_path[len(cookie_path)] == "/")
+
+def domain_matches(host, domain):
+    return host == domain or host.endswith("." + domain)
+
+def is_ip_address(host):
+    return host.replace(".", "").isdigit() or ":" in host
+
+# Domains shared by unrelated sites, which a Domain attribute may not
+# name. Single-label domains like "com" always count; this is not the
+# full public suffix list, just the common registries and hosts.
+PUBLIC_SUFFIXES = {
+    "co.uk", "org.uk", "ac.uk", "gov.uk", "com.au", "net.au", "org.au",
+    "co.jp", "ne.jp", "or.jp", "co.nz", "co.in", "co.za", "com.br",
+    "com.cn", "com.mx", "com.tw", "github.io", "gitlab.io",
+    "herokuapp.com", "appspot.com", "blogspot.com", "cloudfront.net",
+    "azurewebsites.net", "netlify.app", "vercel.app", "pages.dev",
+    "workers.dev",
+}
+
+def is_public_suffix(domain):
+    return "." not in domain or domain in PUBLIC_SUFFIXES
 
+# The host itself and each parent domain, for looking up cookies
+def domain_ancestors(host):
+    yield host
+    if is_ip_address(host): return
+    while "." in host:
+        host = host.split(".", 1)[1]
+        yield host
+
+class Cookie:
+    def __init__(self, name, value, domain, host_only, path, expires, params):
+        self.name = name
+        self.value = value
+        self.domain = domain
+        self.host_only = host_only
+        self.path = path
+        self.expires = expires
+        self.params = params
+
+    def __repr__(self):
+        return "Cookie({}={} domain={} path={})".format(
+            self.name, self.value, self.domain, self.path)
+
+    def pair(self):
+        return self.name + "=" + self.value if self.name else self.value
+
+    def to_json(self):
+        return [self.name, self.value, self.domain, self.host_only,
+                self.path, self.expires, self.params]
+
+COOKIE_PATH = os.path.join(CACHE_DIR, "cookies.json")
+
+# Cookies indexed by domain, then path, then name. Cookie header values
+# are serialised once per origin and set of matching cookie paths, so
+# every page on a site shares an entry, and reused until the jar
+# changes or one of their cookies expires.
+class CookieJar:
+    def __init__(self, path=COOKIE_PATH):
+        self.path = path
+        self.domains = {}
+        self.serialised = {}
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        if self.loaded: return
+        self.loaded = True
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                cookies = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for fields in cookies:
+            cookie = Cookie(*fields)
+            if cookie.expires is not None and cookie.expires > now:
+                self.add(cookie)
+
+    # Only cookies with an expiry outlive the browser
+    def save(self):
+        with self.lock:
+            if not self.loaded: return
+            cookies = [cookie.to_json() for cookie in self.all()
+                       if cookie.expires is not None]
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump(cookies, f)
+            os.replace(tmp, self.path)
+
+    def all(self):
+        for paths in self.domains.values():
+            for names in paths.values():
+                yield from names.values()
+
+    def add(self, cookie):
+        paths = self.domains.setdefault(cookie.domain, {})
+        paths.setdefault(cookie.path, {})[cookie.name] = cookie
+
+    def find(self, domain, path, name):
+        return self.domains.get(domain, {}).get(path, {}).get(name)
+
+    def remove(self, cookie):
+        paths = self.domains[cookie.domain]
+        del paths[cookie.path][cookie.name]
+        if not paths[cookie.path]: del paths[cookie.path]
+        if not paths: del self.domains[cookie.domain]
+
+    def set(self, url, text, from_script=False):
+        if not url.host: return None
+        name, value, params = parse_cookie(text)
+        now = time.time()
+        expires = cookie_expiry(params, now)
+        domain = params.get("domain", "").lstrip(".").casefold()
+        # A Domain naming a public suffix or an IP address only works as
+        # a host-only cookie for that exact host
+        if domain and (is_public_suffix(domain) or is_ip_address(url.host)):
+            if domain != url.host: return None
+            domain = ""
+        if domain and not domain_matches(url.host, domain): return None
+        if "secure" in params and url.scheme != "https": return None
+        host_only = not domain
+        domain = domain or url.host
+        path = params.get("path", "")
+        if not path.startswith("/"):
+            path = default_cookie_path(url.path)
+        if from_script and "httponly" in params: return None
+        with self.lock:
+            self.load()
+            old = self.find(domain, path, name)
+            if old and from_script and "httponly" in old.params:
+                return None
+            if old: self.remove(old)
+            cookie = Cookie(name, value, domain, host_only, path,
+                            expires, params)
+            if expires is None or expires > now:
+                self.add(cookie)
+            self.serialised.clear()
+            if expires is not None or (old and old.expires is not None):
+                self.save()
+        return cookie
+
+    def matching(self, url, now):
+        secure = url.scheme == "https"
+        cookies = []
+        expired = []
+        for domain in domain_ancestors(url.host):
+            for path, names in self.domains.get(domain, {}).items():
+                if not path_matches(url.path, path): continue
+                for cookie in names.values():
+                    if cookie.host_only and domain != url.host: continue
+                    if "secure" in cookie.params and not secure: continue
+                    if cookie.expires is not None and now >= cookie.expires:
+                        expired.append(cookie)
+                        continue
+                    cookies.append(cookie)
+        for cookie in expired:
+            self.remove(cookie)
+        cookies.sort(key=lambda cookie: -len(cookie.path))
+        return cookies
+
+    def matching_paths(self, url):
+        for domain in domain_ancestors(url.host):
+            for path in self.domains.get(domain, ()):
+                if path_matches(url.path, path):
+                    yield domain, path
+
+    def header(self, url, referrer=None, method="GET"):
+        if not url.host: return None
+        cross_site = bool(referrer) and method != "GET" \
+            and referrer.host != url.host
+        now = time.time()
+        with self.lock:
+            self.load()
+            key = (url.host, url.scheme == "https", cross_site,
+                   tuple(self.matching_paths(url)))
+            entry = self.serialised.get(key)
+            if entry and now < entry[1]:
+                return entry[0]
+            cookies = [cookie for cookie in self.matching(url, now)
+                       if not (cross_site and
+                               cookie.params.get("samesite") == "lax")]
+            value = "; ".join(cookie.pair() for cookie in cookies) or None
+            expiry = min([cookie.expires for cookie in cookies
+                          if cookie.expires is not None] or [float("inf")])
+            self.serialised[key] = (value, expiry)
+            return value
+
+    # What document.cookie sees: everything but HttpOnly cookies
+    def script_cookie(self, url):
+        if not url.host: return ""
+        with self.lock:
+            self.load()
+            cookies = self.matching(url, time.time())
+        return "; ".join(cookie.pair() for cookie in cookies
+                         if "httponly" not in cookie.params)
+
+COOKIE_JAR = CookieJar()
+atexit.register(COOKIE_JAR.save)
+
+# Record/replay for benchmarks. While recording, every URL.request is
+# appended to a JSON-lines archive; while replaying, requests are served
+# from that archive and never touch the network, cache or cookie jar.
+class ArchiveMissError(Exception): pass
+
+class NetworkArchive:
+    def __init__(self, path, mode, latency=False):
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.entries = {}
+        if mode == "record":
+            self.file = open(path, "w", encoding="utf8")
+        else:
+            self.file = None
+            with open(path, encoding="utf8") as f:
+                for line in f:
+                    if not line.strip(): continue
+                    entry = json.loads(line)
+                    key = (entry["method"], entry["url"], entry["payload"])
+                    self.entries.setdefault(key, []).append(entry)
+
+    def request(self, url, referrer, payload, on_headers, on_chunk):
+        if self.mode == "replay":
+            return self.replay(url, payload, on_headers, on_chunk)
+        return self.record(url, referrer, payload, on_headers, on_chunk)
+
+    def record(self, url, referrer, payload, on_headers, on_chunk):
+        start = time.perf_counter()
+        first_byte = []
+        def receive_headers(headers, final):
+            first_byte.append(time.perf_counter() - start)
+            if on_headers: on_headers(headers, final)
+        headers, body, final = url.live_request(
+            referrer, payload, receive_headers, on_chunk)
+        elapsed = time.perf_counter() - start
+        entry = {
+            "method": "POST" if payload else "GET",
+            "url": str(url),
+            "final": str(final),
+            "payload": payload,
+            "headers": headers,
+            "body": body,
+            "ttfb": first_byte[0] if first_byte else elapsed,
+            "elapsed": elapsed,
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+        return headers, body, final
+
+    # Repeated requests for the same URL are served in recorded order;
+    # the last recording keeps answering once the others are used up.
+    def replay(self, url, payload, on_headers, on_chunk):
+        key = ("POST" if payload else "GET", str(url), payload)
+        with self.lock:
+            recorded = self.entries.get(key)
+            if not recorded:
+                raise ArchiveMissError(key)
+            entry = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+        record = RequestRecord(str(url), key[0], "archive")
+        log_request(record)
+        headers, body = dict(entry["headers"]), entry["body"]
+        final = URL(entry["final"]) if "final" in entry else url
+        data = body.encode(body_charset(headers), "replace")
+        record.bytes_decoded = len(data)
+        if self.latency: time.sleep(entry["ttfb"])
+        if on_headers: on_headers(headers, final)
+        if self.latency: time.sleep(max(0, entry["elapsed"] - entry["ttfb"]))
+        if on_chunk and data: on_chunk(data)
+        record.finish()
+        return dict(headers), body, final
+
+    def close(self):
+        if self.file: self.file.close()
+
+ARCHIVE = None
+
+def start_recording(path):
+    global ARCHIVE
+    stop_archive()
+    ARCHIVE = NetworkArchive(path, "record")
+
+def start_replay(path, latency=False):
+    global ARCHIVE
+    stop_archive()
+    ARCHIVE = NetworkArchive(path, "replay", latency)
+
+def stop_archive():
+    global ARCHIVE
+    if ARCHIVE: ARCHIVE.close()
+    ARCHIVE = None
+
+atexit.register(stop_archive)
+
+# Runs network work on an asyncio loop in a background thread, so the Tk
+# main loop never blocks on a socket. Blocking URL.request calls run on
+# the loop's executor; results come back as asyncio or concurrent futures.
+class NetworkEngine:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.loop.run_in_executor(
+            None, functools.partial(fn, *args, **kwargs))
+
+    async def fetch(self, url, referrer, payload=None,
+                    on_headers=None, on_chunk=None):
+        return await self.run(
+            url.request, referrer, payload, on_headers, on_chunk)
+
+    async def wait(self, futures):
+        await asyncio.gather(
+            *[asyncio.wrap_future(future) for future in futures],
+            return_exceptions=True)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# Fetch priority classes, most urgent first
+PRIORITY_STYLESHEET = 0
+PRIORITY_SCRIPT = 1
+PRIORITY_XHR = 2
+PRIORITY_PREFETCH = 3
+
+# Runs fetches on a fixed set of worker threads. A free worker always
+# takes the most urgent queued task, oldest first, whose origin is below
+# max_per_origin running tasks; tasks submitted without a URL have no
+# origin limit. XHRs and prefetches together never hold the last
+# `reserved` workers, and prefetches never hold more than max_prefetch,
+# so a stylesheet or script always has a worker to start on.
+class FetchScheduler:
+    def __init__(self, workers=8, max_per_origin=6, reserved=2,
+                 max_prefetch=2):
+        self.max_per_origin = max_per_origin
+        self.max_background = max(1, workers - reserved)
+        self.max_prefetch = max_prefetch
+        self.queues = [collections.deque() for _ in range(PRIORITY_PREFETCH + 1)]
+        self.running = [0] * len(self.queues)
+        self.active = collections.Counter()
+        self.condition = threading.Condition()
+        for _ in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, priority, url, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        origin = (url.scheme, url.host, url.port) if url else None
+        with self.condition:
+            self.queues[priority].append(
+                (origin, future, functools.partial(fn, *args, **kwargs)))
+            self.condition.notify()
+        return future
+
+    def may_start(self, priority):
+        if priority < PRIORITY_XHR: return True
+        if sum(self.running[PRIORITY_XHR:]) >= self.max_background:
+            return False
+        return priority != PRIORITY_PREFETCH or \
+            self.running[PRIORITY_PREFETCH] < self.max_prefetch
+
+    def next_task(self):
+        for priority, tasks in enumerate(self.queues):
+            if not tasks or not self.may_start(priority): continue
+            for task in tasks:
+                origin = task[0]
+                if origin is None or \
+                    self.active[origin] < self.max_per_origin:
+                    tasks.remove(task)
+                    return priority, task
+        return None, None
+
+    def work(self):
+        while True:
+            with self.condition:
+                priority, task = self.next_task()
+                while task is None:
+                    self.condition.wait()
+                    priority, task = self.next_task()
+                origin, future, call = task
+                if origin: self.active[origin] += 1
+                self.running[priority] += 1
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(call())
+                except BaseException as e:
+                    future.set_exception(e)
+            with self.condition:
+                if origin:
+                    self.active[origin] -= 1
+                    if not self.active[origin]: del self.active[origin]
+                self.running[priority] -= 1
+                self.condition.notify_all()
+
+FETCH_SCHEDULER = FetchScheduler()
+
+# Parsed URLs are cached by their text, and resolved URLs by (base,
+# relative), so pages that mention the same links over and over only
+# parse each one once.
+URL_CACHE_SIZE = 4096
+
+# URLs are immutable values: parsing happens once, in parse_url, and
+# URL(text) hands back the cached result. redirect counts the hops that
+# led here and is the only thing that differs between equal URLs.
+class URL:
+    __slots__ = ("scheme", "host", "port", "path", "redirect", "text")
+
+    def __new__(cls, url, redirect=0):
+        if (redirect >= 10):
+            raise RedirectLoopError(Exception("Too many redirects"))
+        parsed = parse_url(url)
+        if redirect == 0:
+            return parsed
+        return parsed.with_redirect(redirect)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("URL is immutable")
+
+    def __repr__(self):
+        return "URL(scheme={}, host={}, port={}, path={!r})".format(
+            self.scheme, self.host, self.port, self.path)
     
+    def __str__(self):
+        if self.text is None and self.scheme == "file":
+            object.__setattr__(self, "text", "file://" + self.path)
+        if self.text is None:
+            port_part = ":" + str(self.port)
+            if self.scheme == "https" and self.port == 443:
+                port_part = ""
+            if self.scheme == "http" and self.port == 80:
+                port_part = ""
+            text = self.scheme + "://" + self.host + port_part + self.path
+            object.__setattr__(self, "text", text)
+        return self.text
+
+    def __eq__(self, other):
+        return isinstance(other, URL) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def key(self):
+        return (self.scheme, self.host, self.port, self.path)
+
+    def with_redirect(self, redirect):
+        url = object.__new__(URL)
+        for name in URL.__slots__:
+            object.__setattr__(url, name, getattr(self, name))
+        object.__setattr__(url, "redirect", redirect)
+        return url
+
+    # timeout bounds the TCP connect and TLS handshake only
+    def connect(self, timeout=None):
+        conn = Connection(self.scheme, self.host, self.port, timeout)
         if self.scheme == "https":
-            ctx = ssl.create_default_context()
             #ch10-certificate-errors
             try:
-                s = ctx.wrap_socket(s, server_hostname=self.host)
+                conn.start_tls()
             except Exception:
-                return {"invalid-certificate": True}, "<!doctype html> Secure Connection Failed"
-    
+                conn.close()
+                return None
+        conn.sock.settimeout(None)
+        return conn
+
+    # Returns (headers, body, url), where url is the one the response
+    # came from after any redirects. on_headers(headers, url) and
+    # on_chunk let callers watch a response as it streams in; cached
+    # responses are replayed through them too.
+    def request(self, referrer, payload=None,
+                on_headers=None, on_chunk=None):
+        if ARCHIVE:
+            return ARCHIVE.request(
+                self, referrer, payload, on_headers, on_chunk)
+        return self.live_request(referrer, payload, on_headers, on_chunk)
+
+    # Redirect hops pass coalesce=False: a chain that comes back to a URL
+    # this thread is already fetching must reach the redirect limit, not
+    # wait on its own INFLIGHT entry.
+    def live_request(self, referrer, payload=None,
+                     on_headers=None, on_chunk=None, coalesce=True):
+        if self.scheme == "file":
+            return self.read_file(on_headers, on_chunk)
+        if payload:
+            return self.fetch(referrer, payload, None, on_headers, on_chunk)
+
+        target = HTTP_CACHE.lookup_redirect(str(self))
+        if target:
+            return URL(target, self.redirect + 1).live_request(
+                referrer, None, on_headers, on_chunk, coalesce)
+        if not coalesce:
+            return self.cached_fetch(referrer, on_headers, on_chunk)
+
+        key = (str(self), self.cookie_header(referrer, "GET"))
+        with INFLIGHT_LOCK:
+            shared = INFLIGHT.get(key)
+            leader = shared is None
+            if leader:
+                shared = INFLIGHT[key] = concurrent.futures.Future()
+
+        if not leader:
+            record = RequestRecord(str(self), "GET", "coalesced")
+            log_request(record)
+            headers, body, url = shared.result()
+            record.finish()
+            data = body.encode(body_charset(headers), "replace")
+            replay_cached(url, headers, data, on_headers, on_chunk)
+            return dict(headers), body, url
+
+        try:
+            response = self.cached_fetch(referrer, on_headers, on_chunk)
+        except Exception as e:
+            with INFLIGHT_LOCK:
+                del INFLIGHT[key]
+            shared.set_exception(e)
+            raise
+        with INFLIGHT_LOCK:
+            del INFLIGHT[key]
+        shared.set_result(response)
+        return response
+
+    def cached_fetch(self, referrer, on_headers=None, on_chunk=None):
+        cached = HTTP_CACHE.lookup(str(self))
+        if not cached:
+            return self.fetch(referrer, None, None, on_headers, on_chunk)
+        headers, body, state = cached
+        if state == "stale":
+            return self.fetch(referrer, None, (headers, body),
+                              on_headers, on_chunk)
+        record = RequestRecord(str(self), "GET", "hit")
+        if state == "stale-while-revalidate":
+            record.cache = "stale-hit"
+            HTTP_CACHE.revalidate_in_background(str(self),
+                lambda: self.fetch(referrer, cached=(headers, body)))
+        record.status = 200
+        record.bytes_decoded = len(body)
+        log_request(record)
+        replay_cached(self, headers, body, on_headers, on_chunk)
+        record.finish()
+        return headers, decode_body(headers, body), self
+
+    # Local files are memory-mapped instead of read: on_chunk gets the
+    # file a CHUNK_SIZE piece at a time and the text is decoded straight
+    # from the mapping, so the file is never copied whole into bytes.
+    def read_file(self, on_headers=None, on_chunk=None):
+        record = RequestRecord(str(self), "GET", "file")
+        log_request(record)
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            headers = {"content-length": str(size)}
+            if on_headers: on_headers(headers, self)
+            if size == 0:
+                body = ""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if on_chunk:
+                        for start in range(0, size, CHUNK_SIZE):
+                            on_chunk(m[start:start + CHUNK_SIZE])
+                    body = decode_body(headers, m)
+        record.status = 200
+        record.bytes_decoded = size
+        record.finish()
+        return headers, body, self
+
+    def cookie_header(self, referrer, method):
+        return COOKIE_JAR.header(self, referrer, method)
+
+    def fetch(self, referrer, payload=None, cached=None,
+              on_headers=None, on_chunk=None):
         method = "POST" if payload else "GET"
-        request = "{} {} HTTP/1.0\r\n".format(method, self.path)
+        request = "{} {} HTTP/1.1\r\n".format(method, self.path)
         request += "Host: {}\r\n".format(self.host)
-        if self.host in COOKIE_JAR:
-            cookie, params = COOKIE_JAR[self.host]
-            allow_cookie = True
-            if referrer and params.get("samesite", "none") == "lax":
-                if method != "GET":
-                    allow_cookie = self.host == referrer.host
-            if allow_cookie:
-                request += "Cookie: {}\r\n".format(cookie)
+        request += "Connection: keep-alive\r\n"
+        request += "Accept-Encoding: gzip, deflate\r\n"
+        cookie = self.cookie_header(referrer, method)
+        if cookie:
+            request += "Cookie: {}\r\n".format(cookie)
+        if cached:
+            for header, value in conditional_headers(cached[0]).items():
+                request += "{}: {}\r\n".format(header, value)
         if payload:
             content_length = len(payload.encode("utf8"))
             request += "Content-Length: {}\r\n".format(content_length)
         request += "\r\n"
         if payload: request += payload
-        s.send(request.encode("utf8"))
-        response = s.makefile("r", encoding="utf8", newline="\r\n")
-    
-        statusline = response.readline()
-        version, status, explanation = statusline.split(" ", 2)
-    
-        response_headers = {}
+
+        record = RequestRecord(str(self), method)
+        log_request(record)
+        # A pooled socket may have been closed by the server while idle,
+        # so a failure on a reused connection retries on a fresh one.
         while True:
-            line = response.readline()
-            if line == "\r\n": break
-            header, value = line.split(":", 1)
-            response_headers[header.casefold()] = value.strip()
-    
-        if "set-cookie" in response_headers:
-            cookie = response_headers["set-cookie"]
-            cookie, params = self.get_cookie(cookie)
-            # params = {}
-        
-        assert "transfer-encoding" not in response_headers
-        assert "content-encoding" not in response_headers
-    
-        content = response.read()
-        s.close()
-    
-        return response_headers, content
-    
-    # ch10 script access exercise
-    def get_cookie(self, cookie):
-        params = {}
-        if ";" in cookie:
-            cookie, rest = cookie.split(";", 1)
-            for param in rest.split(";"):
-                if '=' in param:
-                    param, value = param.split("=", 1)
-                else:
-                    value = "true"
-                params[param.strip().casefold()] = value.casefold()
-        COOKIE_JAR[self.host] = (cookie, params)
-        return cookie, params
+            conn = CONNECTION_POOL.get(self.scheme, self.host, self.port)
+            reused = conn is not None
+            if not conn:
+                conn = self.connect()
+                if not conn:
+                    record.finish()
+                    return {"invalid-certificate": True}, \
+                        "<!doctype html> Secure Connection Failed", self
+            try:
+                sent = time.perf_counter()
+                conn.sock.sendall(request.encode("utf8"))
+                response = conn.reader()
+                head = response.read_head()
+                first_byte = time.perf_counter()
+                if not head:
+                    raise ConnectionError("Connection closed by server")
+            except OSError:
+                conn.close()
+                if reused: continue
+                raise
+            break
 
-    def resolve(self, url):
-        if "://" in url: return URL(url)
-        if not url.startswith("/"):
-            dir, _ = self.path.rsplit("/", 1)
-            while url.startswith("../"):
-                _, url = url.split("/", 1)
-                if "/" in dir:
-                    dir, _ = dir.rsplit("/", 1)
-            url = dir + "/" + url
-        if url.startswith("//"):
-            return URL(self.scheme + ":" + url)
+        version, status, response_headers, cookies = parse_head(head)
+
+        for cookie in cookies:
+            COOKIE_JAR.set(self, cookie)
+
+        record.status = status
+        record.reused = reused
+        if not reused:
+            record.phases["dns"] = conn.dns_time
+            record.phases["connect"] = conn.connect_time
+            record.phases["tls"] = conn.tls_time
+        record.phases["ttfb"] = first_byte - sent
+        if status == 304 and cached:
+            record.cache = "revalidated"
+        # A redirect's own headers and body are not passed to callers
+        redirect = 300 <= status < 400 and status != 304 \
+            and "location" in response_headers
+        body_chunk = None if redirect else on_chunk
+        if on_headers and not redirect and not (status == 304 and cached):
+            on_headers(response_headers, self)
+
+        has_body = status >= 200 and status not in (204, 304)
+        chunked = response_headers.get(
+            "transfer-encoding", "").casefold() == "chunked"
+        keep_alive = version == "HTTP/1.1" and \
+            ("content-length" in response_headers or chunked
+             or not has_body) and \
+            response_headers.get("connection", "").casefold() != "close"
+
+        encoding = response_headers.get(
+            "content-encoding", "identity").casefold()
+        record.content_encoding = encoding
+        if has_body and not chunked and encoding == "identity" \
+            and "content-length" in response_headers:
+            content = self.read_content(response,
+                int(response_headers["content-length"]), record, body_chunk)
+        else:
+            if not has_body:
+                body = iter(())
+            elif chunked:
+                body = read_chunked(response)
+            elif "content-length" in response_headers:
+                body = read_length(
+                    response, int(response_headers["content-length"]))
+            else:
+                body = read_until_close(response)
+
+            # Compressed responses are decoded chunk by chunk as they arrive
+            decoder = ContentDecoder(encoding)
+            chunks = []
+            for data in body:
+                record.bytes_on_wire += len(data)
+                data = decoder.decode(data)
+                record.bytes_decoded += len(data)
+                chunks.append(data)
+                if body_chunk and data: body_chunk(data)
+            data = decoder.flush()
+            record.bytes_decoded += len(data)
+            chunks.append(data)
+            if body_chunk and data: body_chunk(data)
+            content = b"".join(chunks)
+        response_headers.pop("content-encoding", None)
+        response_headers.pop("transfer-encoding", None)
+        record.finish()
+        record.phases["body"] = record.end - first_byte
+
+        if self.scheme == "https":
+            conn.save_session()
+        if keep_alive:
+            CONNECTION_POOL.put(conn)
         else:
-            return URL(self.scheme + "://" + self.host + \
-                       ":" + str(self.port) + url)
+            conn.close()
+
+        if redirect:
+            return self.follow_redirect(status, response_headers["location"],
+                referrer, payload, on_headers, on_chunk)
+        if status == 304 and cached:
+            headers, body = cached
+            headers = HTTP_CACHE.refresh(str(self), response_headers) or headers
+            replay_cached(self, headers, body, on_headers, on_chunk)
+            return headers, decode_body(headers, body), self
+        if method == "GET" and status == 200:
+            HTTP_CACHE.store(str(self), response_headers, content)
+
+        return response_headers, decode_body(response_headers, content), self
+
+    # 301 and 308 are remembered so later requests skip the hop; 307 and
+    # 308 resend the payload, the others become a GET.
+    def follow_redirect(self, status, location, referrer, payload,
+                        on_headers, on_chunk):
+        target = URL(str(self.resolve(location)), self.redirect + 1)
+        if status in (301, 308) and not payload:
+            HTTP_CACHE.remember_redirect(str(self), str(target))
+        if status not in (307, 308):
+            payload = None
+        return target.live_request(
+            referrer, payload, on_headers, on_chunk, coalesce=False)
+
+    # An uncompressed body of known length is received straight into a
+    # buffer of that size; on_chunk sees views of it as it fills.
+    def read_content(self, response, length, record, on_chunk):
+        content = bytearray(length)
+        view = memoryview(content)
+        filled = 0
+        while filled < length:
+            count = response.read_into(view[filled:filled + CHUNK_SIZE])
+            if not count:
+                raise ConnectionError("Connection closed mid-body")
+            if on_chunk: on_chunk(view[filled:filled + count])
+            filled += count
+        record.bytes_on_wire = record.bytes_decoded = length
+        return content
+    
+    def resolve(self, url):
+        return resolve_url(self, url)
     
     def origin(self):
         return self.scheme + "://" + self.host + ":" + str(self.port)
 
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def parse_url(url):
+    scheme, url = url.split("://", 1)
+    assert scheme in ("http", "https", "file")
+
+    host = None
+    port = None
+    if scheme == "http":
+        port = 80
+    elif scheme == "https":
+        port = 443
+
+    if scheme != "file":
+        if "\\" in url:
+            _, url = url.split("\\", 1)
+        if "/" not in url:
+            url = url + "/"
+        host, url = url.split("/", 1)
+        path = "/" + url
+        if ":" in host:
+            host, port = host.split(":", 1)
+            port = int(port)
+        host = sys.intern(host)
+    else:
+        path = url
+
+    parsed = object.__new__(URL)
+    for name, value in (("scheme", sys.intern(scheme)), ("host", host),
+                        ("port", port), ("path", path), ("redirect", 0),
+                        ("text", None)):
+        object.__setattr__(parsed, name, value)
+    return parsed
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def resolve_url(base, url):
+    if "://" in url: return URL(url)
+    if not url.startswith("/"):
+        dir, _ = base.path.rsplit("/", 1)
+        while url.startswith("../"):
+            _, url = url.split("/", 1)
+            if "/" in dir:
+                dir, _ = dir.rsplit("/", 1)
+        url = dir + "/" + url
+    if base.scheme == "file":
+        return URL("file://" + url)
+    if url.startswith("//"):
+        return URL(base.scheme + ":" + url)
+    else:
+        return URL(base.scheme + "://" + base.host + \
+                   ":" + str(base.port) + url)
+
 def tree_to_list(tree, list):
     list.append(tree)
     for child in tree.children: